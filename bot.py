@@ -1,14 +1,16 @@
+import asyncio
 import sqlite3
 import csv
-import re
+import io
+import math
 import logging
-from datetime import datetime
+import threading
+from datetime import datetime, date
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from telegram.constants import ParseMode
-from time import sleep
-from sklearn.linear_model import LinearRegression
+from cachetools import LRUCache
 import numpy as np
 import pickle
 
@@ -16,6 +18,9 @@ import pickle
 MAX_MSG_LEN = 4096
 DB_PATH = 'transactions.db'
 RATE_LIMIT_DELAY = 0.05  # 50ms delay between each broadcast message
+BROADCAST_CONCURRENCY = 20  # Max simultaneous sends during a broadcast
+BROADCAST_DB_BATCH = 1000  # Recipients fetched from the DB per batch
+EXPORT_DB_BATCH = 1000  # Rows fetched from the DB per batch during export
 ADMIN_ID = 831902456  # Replace with actual admin user ID
 TRANSACTION_THRESHOLD = 1000  # Notify admins if transaction exceeds this value
 
@@ -25,67 +30,246 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Cache for frequently accessed data
-user_totals_cache = {}
+# Cache for frequently accessed data; bounded so cold chat IDs are
+# evicted instead of growing the cache forever. LRUCache is not
+# thread-safe and the totals are read-modify-written from several
+# to_thread workers, so updates go through this lock
+user_totals_cache = LRUCache(maxsize=50_000)
+_totals_lock = threading.Lock()
+
+# Incoming transactions are queued here and written in batches, so the
+# database sees one transaction per flush instead of one per row. The
+# queue is touched from handler worker threads and the scheduler thread,
+# so every access goes through its own lock (_db_lock only guards the
+# connection)
+_pending = []
+_pending_lock = threading.Lock()
+FLUSH_INTERVAL = 0.5  # seconds between background flushes
+FLUSH_BATCH_SIZE = 1000  # flush immediately once this many rows are queued
+
+# Single long-lived connection shared by the whole process; the lock
+# serializes access between the event loop and scheduler worker threads
+_conn = None
+_db_lock = threading.Lock()
+
+def init_db_connection():
+    global _conn
+    if _conn is None:
+        # isolation_level=None leaves transaction control to us: single
+        # statements autocommit, batches use explicit BEGIN/COMMIT.
+        # cached_statements keeps recurring SQL prepared across calls
+        _conn = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False,
+                                cached_statements=256)
+        # WAL turns each commit into a log append and lets readers run
+        # alongside the writer; the other PRAGMAs reduce fsyncs and keep
+        # temp/page data in memory
+        _conn.execute('PRAGMA journal_mode=WAL')
+        _conn.execute('PRAGMA synchronous=NORMAL')
+        _conn.execute('PRAGMA temp_store=MEMORY')
+        _conn.execute('PRAGMA mmap_size=268435456')
+        _conn.execute('PRAGMA cache_size=-65536')
+    return _conn
 
 # Database context manager for safer handling
 class Database:
     def __enter__(self):
+        _db_lock.acquire()
         try:
-            self.conn = sqlite3.connect(DB_PATH)
+            self.conn = init_db_connection()
             self.cursor = self.conn.cursor()
         except sqlite3.Error as e:
+            # Release and re-raise: __exit__ never runs when __enter__
+            # fails, and a swallowed error would leave the lock held
+            _db_lock.release()
             logger.error(f"Error connecting to database: {e}")
+            raise
         return self.cursor
 
     def __exit__(self, exc_type, exc_value, traceback):
         try:
-            self.conn.commit()
-            self.conn.close()
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                # Never commit a half-applied block: the batch flush
+                # requeues its rows on failure, so committing a prefix
+                # here would make the retry insert those rows twice
+                self.conn.rollback()
         except sqlite3.Error as e:
-            logger.error(f"Error closing database connection: {e}")
+            logger.error(f"Error finishing database transaction: {e}")
+        finally:
+            _db_lock.release()
 
 # Utility functions
+def init_db_indexes():
+    with Database() as db:
+        db.execute('CREATE INDEX IF NOT EXISTS idx_tx_chatid ON transactions(chat_id)')
+        # Composite index lets the per-user GROUP BY date read rows in
+        # date order without a sort
+        db.execute('CREATE INDEX IF NOT EXISTS idx_tx_chatid_date ON transactions(chat_id, date)')
+        db.execute('ANALYZE')
+
 def add_user(chat_id, role='user'):
     with Database() as db:
         db.execute("INSERT OR IGNORE INTO users (chat_id, role) VALUES (?, ?)", (chat_id, role))
 
 def save_transaction(chat_id, amount, category="general"):
-    date = datetime.now().strftime("%Y-%m-%d")
+    # Seed the cached total before the row is queued: once the append is
+    # visible a flush may already have written it, and a DB seed taken
+    # after that would count the amount twice. The totals lock keeps two
+    # concurrent messages from the same user from losing an increment
+    with _totals_lock:
+        prev = user_totals_cache.get(chat_id)
+        if prev is None:
+            prev = _db_sum(chat_id)
+        total = prev + amount
+        user_totals_cache[chat_id] = total
+        # isoformat is C-implemented and much cheaper than strftime
+        with _pending_lock:
+            _pending.append((amount, date.today().isoformat(), category, chat_id))
+            need_flush = len(_pending) >= FLUSH_BATCH_SIZE
+    if need_flush:
+        flush_pending_transactions()
+    return total
+
+def save_transactions(rows):
+    if not rows:
+        return
     with Database() as db:
-        db.execute('INSERT INTO transactions (amount, date, category, chat_id) VALUES (?, ?, ?, ?)', 
-                   (amount, date, category, chat_id))
-    user_totals_cache[chat_id] = get_total(chat_id)  # Update cache
+        # Explicit transaction so the batch costs a single fsync
+        db.execute('BEGIN')
+        db.executemany('INSERT INTO transactions (amount, date, category, chat_id) VALUES (?, ?, ?, ?)', rows)
+        db.execute('COMMIT')
+
+def flush_pending_transactions():
+    # Swap the queue out atomically so two concurrent flushes can never
+    # pick up (and insert) the same rows
+    with _pending_lock:
+        if not _pending:
+            return
+        rows, _pending[:] = _pending[:], []
+    try:
+        save_transactions(rows)
+    except sqlite3.Error:
+        # Put the rows back so a failed insert doesn't drop transactions
+        # the user was already told were saved; the next flush retries
+        with _pending_lock:
+            _pending[:0] = rows
+        raise
+
+def _db_sum(chat_id):
+    # Queued rows aren't visible to the SELECT yet, so a cold-cache seed
+    # taken mid-flush-window would silently undercount and then stick;
+    # flush first, like the export/graph/reset paths already do
+    flush_pending_transactions()
+    with Database() as db:
+        # COALESCE makes SQLite return 0 for users with no rows, so no
+        # Python-side fallback is needed
+        db.execute('SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE chat_id = ?', (chat_id,))
+        return db.fetchone()[0]
 
 def get_total(chat_id):
-    if chat_id in user_totals_cache:
-        return user_totals_cache[chat_id]
-
-    with Database() as db:
-        db.execute('SELECT SUM(amount) FROM transactions WHERE chat_id = ?', (chat_id,))
-        total = db.fetchone()[0] or 0
-        user_totals_cache[chat_id] = total  # Cache the total
+    with _totals_lock:
+        total = user_totals_cache.get(chat_id)
+        if total is None:
+            total = _db_sum(chat_id)
+            user_totals_cache[chat_id] = total  # Cache the total
         return total
 
+def _ols(x, y):
+    # Closed-form least squares over float64 arrays
+    n = x.size
+    sx = x.sum()
+    sy = y.sum()
+    sxx = (x * x).sum()
+    sxy = (x * y).sum()
+    m = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+    b = (sy - m * sx) / n
+    return m, b
+
+try:
+    # With numba available, compute the sums in one fused loop with no
+    # temporary arrays; the vectorized version above stays the fallback
+    from numba import njit
+
+    @njit(cache=True, fastmath=True)
+    def _ols(x, y):
+        n = x.size
+        sx = 0.0
+        sy = 0.0
+        sxx = 0.0
+        sxy = 0.0
+        for i in range(n):
+            sx += x[i]
+            sy += y[i]
+            sxx += x[i] * x[i]
+            sxy += x[i] * y[i]
+        m = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+        b = (sy - m * sx) / n
+        return m, b
+except ImportError:
+    pass
+
+# In-memory (slope, intercept) model; refreshed by train_model and
+# seeded from model.pkl at startup so predictions never touch the disk
+_model = None
+
+def load_model():
+    global _model
+    try:
+        with open('model.pkl', 'rb') as f:
+            loaded = pickle.load(f)
+    except Exception as e:
+        # A model.pkl from before the NumPy rewrite holds a pickled
+        # sklearn estimator and can raise ModuleNotFoundError here; any
+        # unreadable pickle just means we wait for the next retrain
+        logger.warning(f"No saved model loaded: {e}")
+        return
+    if isinstance(loaded, tuple) and len(loaded) == 2 and all(isinstance(v, float) for v in loaded):
+        _model = loaded
+    else:
+        logger.warning("Ignoring model.pkl with unexpected format; will retrain")
+
 def train_model():
+    global _model
     with Database() as db:
-        db.execute("SELECT date, SUM(amount) FROM transactions GROUP BY date")
+        # julianday hands back a float X directly, so the per-row
+        # strptime/toordinal loop disappears
+        db.execute("SELECT CAST(julianday(date) AS REAL), SUM(amount) "
+                   "FROM transactions GROUP BY date ORDER BY date")
         transactions = db.fetchall()
 
-    dates = np.array([datetime.strptime(row[0], "%Y-%m-%d").toordinal() for row in transactions]).reshape(-1, 1)
-    amounts = np.array([row[1] for row in transactions])
-
-    if len(dates) > 1:
-        model = LinearRegression().fit(dates, amounts)
+    if len(transactions) > 1:
+        arr = np.array(transactions, dtype=np.float64)
+        m, b = _ols(np.ascontiguousarray(arr[:, 0]), np.ascontiguousarray(arr[:, 1]))
+        _model = (m, b)
         with open('model.pkl', 'wb') as f:
-            pickle.dump(model, f)
+            pickle.dump((m, b), f)
 
-def predict_future(date_str):
-    with open('model.pkl', 'rb') as f:
-        model = pickle.load(f)
+async def _train_model_job():
+    # Training reads the whole table and fits the model; keep it off the
+    # event loop so handlers stay responsive while it runs
+    await asyncio.to_thread(train_model)
 
-    future_date = datetime.strptime(date_str, "%Y-%m-%d").toordinal()
-    return model.predict([[future_date]])[0]
+def predict_future(date_str):
+    if _model is None:
+        load_model()
+    if _model is None:
+        raise ValueError("No trained model available yet")
+    m, b = _model
+
+    # The model is trained on julianday values; proleptic ordinal day 1
+    # is julian day 1721424.5
+    future_date = datetime.strptime(date_str, "%Y-%m-%d").toordinal() + 1721424.5
+    return m * future_date + b
+
+# Strong references to fire-and-forget tasks so they aren't GC'd mid-flight
+_background_tasks = set()
+
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
 
 # Real-time collaboration feature: notify group when a transaction is added
 async def notify_group(chat_id, amount):
@@ -97,15 +281,15 @@ async def notify_admin_if_threshold_exceeded(chat_id, amount):
     if amount > TRANSACTION_THRESHOLD:
         await bot.send_message(chat_id=ADMIN_ID, text=f"User {chat_id} added a high transaction of {amount}!")
 
-# Admin panel: inline keyboard
+# Admin panel: inline keyboard (immutable, so built once at import)
+_ADMIN_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("View Users", callback_data='view_users')],
+    [InlineKeyboardButton("Check Bot Status", callback_data='check_status')],
+    [InlineKeyboardButton("Broadcast Message", callback_data='broadcast_message')]
+])
+
 async def admin_panel(update: Update, context):
-    keyboard = [
-        [InlineKeyboardButton("View Users", callback_data='view_users')],
-        [InlineKeyboardButton("Check Bot Status", callback_data='check_status')],
-        [InlineKeyboardButton("Broadcast Message", callback_data='broadcast_message')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text('Admin Panel', reply_markup=reply_markup)
+    await update.message.reply_text('Admin Panel', reply_markup=_ADMIN_KEYBOARD)
 
 async def handle_callback_query(update: Update, context):
     query = update.callback_query
@@ -122,48 +306,91 @@ async def bot_status(update: Update, context):
     await update.message.reply_text("Bot is running smoothly.")
 
 # Caching: clear cache command for admin
+def _clear_totals_cache():
+    with _totals_lock:
+        user_totals_cache.clear()
+
 async def clear_cache(update: Update, context):
-    user_totals_cache.clear()
+    # Workers hold _totals_lock across DB work (resets, cold seeds), so
+    # taking it on the event loop could freeze the loop for that long
+    await asyncio.to_thread(_clear_totals_cache)
     await update.message.reply_text("Cache cleared.")
 
 # Export transactions as CSV
-async def export_transactions(update: Update, context):
-    user_id = update.message.chat.id
-    with Database() as db:
-        transactions = db.execute("SELECT * FROM transactions WHERE chat_id = ?", (user_id,)).fetchall()
-
-    file_name = f'transactions_{user_id}.csv'
+def _export_csv(user_id, file_name):
+    flush_pending_transactions()
+    # Fetch under the lock but write outside it, mirroring the broadcast
+    # recipient batches: a large export must not hold up every other
+    # handler's DB access for the duration of the file write
+    cursor = init_db_connection().cursor()
+    with _db_lock:
+        cursor.execute("SELECT * FROM transactions WHERE chat_id = ?", (user_id,))
     with open(file_name, 'w', newline='') as file:
         writer = csv.writer(file)
         writer.writerow(["ID", "Amount", "Date", "Category", "Chat ID"])
-        writer.writerows(transactions)
+        while True:
+            with _db_lock:
+                rows = cursor.fetchmany(EXPORT_DB_BATCH)
+            if not rows:
+                break
+            writer.writerows(rows)
+
+async def export_transactions(update: Update, context):
+    user_id = update.message.chat.id
+    file_name = f'transactions_{user_id}.csv'
+    # Query + file write are blocking; keep them off the event loop
+    await asyncio.to_thread(_export_csv, user_id, file_name)
 
-    await context.bot.send_document(chat_id=user_id, document=open(file_name, 'rb'))
+    with open(file_name, 'rb') as file:
+        await context.bot.send_document(chat_id=user_id, document=file)
 
 # Lazy loading of matplotlib for graph generation
+def _graph_points(user_id):
+    flush_pending_transactions()
+    with Database() as db:
+        cur = db.execute("SELECT date, SUM(amount) FROM transactions WHERE chat_id = ? GROUP BY date",
+                         (user_id,))
+        # Fill the plot columns while iterating the cursor; no
+        # intermediate row list or zip(*rows) transpose
+        dates = []
+        totals = []
+        for d, t in cur:
+            dates.append(d)
+            totals.append(t)
+    return dates, totals
+
 async def send_graph(update: Update, context):
     user_id = update.message.chat.id
-    with Database() as db:
-        transactions = db.execute("SELECT date, SUM(amount) FROM transactions WHERE chat_id = ? GROUP BY date", 
-                                  (user_id,)).fetchall()
-
-    if transactions:
-        dates, totals = zip(*transactions)
-        import matplotlib.pyplot as plt  # Lazy import to optimize memory
-        plt.plot(dates, totals)
-        plt.title('Transaction History')
-        plt.xlabel('Date')
-        plt.ylabel('Total Amount')
-        plt.savefig('transaction_graph.png')
-        await context.bot.send_photo(chat_id=user_id, photo=open('transaction_graph.png', 'rb'))
+    dates, totals = await asyncio.to_thread(_graph_points, user_id)
+
+    if dates:
+        import matplotlib  # Lazy import to optimize memory
+        matplotlib.use('Agg')  # Headless rendering, no GUI machinery
+        import matplotlib.pyplot as plt
+        fig, ax = plt.subplots()
+        ax.plot(dates, totals)
+        ax.set_title('Transaction History')
+        ax.set_xlabel('Date')
+        ax.set_ylabel('Total Amount')
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png')
+        plt.close(fig)  # Release figure memory
+        buf.seek(0)
+        await context.bot.send_photo(chat_id=user_id, photo=buf)
     else:
         await update.message.reply_text("No transactions found.")
 
 # Reset user transactions
+def _reset_user(user_id):
+    with _totals_lock:
+        flush_pending_transactions()  # Don't let queued rows outlive the reset
+        with Database() as db:
+            db.execute('DELETE FROM transactions WHERE chat_id = ?', (user_id,))
+        user_totals_cache[user_id] = 0
+
 async def reset_transactions(update: Update, context):
     user_id = update.message.chat.id
-    with Database() as db:
-        db.execute('DELETE FROM transactions WHERE chat_id = ?', (user_id,))
+    await asyncio.to_thread(_reset_user, user_id)
     await update.message.reply_text("All your transactions have been reset.")
 
 # Broadcast with Markdown support and rate limiting
@@ -173,56 +400,95 @@ async def broadcast_message(update: Update, context):
         return
 
     message = " ".join(context.args).replace("\\n", "\n")
-    with Database() as db:
-        users = db.execute("SELECT chat_id FROM users").fetchall()
 
-    for user in users:
-        for chunk in [message[i:i + MAX_MSG_LEN] for i in range(0, len(message), MAX_MSG_LEN)]:
+    # Chunks are identical for every user, so build them once; the usual
+    # short broadcast needs no slicing at all
+    if len(message) <= MAX_MSG_LEN:
+        chunks = [message]
+    else:
+        chunks = [message[i:i + MAX_MSG_LEN] for i in range(0, len(message), MAX_MSG_LEN)]
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def bounded_send(chat_id, chunk):
+        async with semaphore:
             try:
-                await context.bot.send_message(chat_id=user[0], text=chunk, parse_mode=ParseMode.MARKDOWN)
-                sleep(RATE_LIMIT_DELAY)
+                await context.bot.send_message(chat_id=chat_id, text=chunk, parse_mode=ParseMode.MARKDOWN)
+                await asyncio.sleep(RATE_LIMIT_DELAY)
             except Exception as e:
-                logger.error(f"Error sending message to {user[0]}: {e}")
+                logger.error(f"Error sending message to {chat_id}: {e}")
+
+    # Stream recipients instead of materializing the whole user table;
+    # the lock is only held while fetching, never during the sends
+    cursor = init_db_connection().cursor()
+
+    def run_users_query():
+        with _db_lock:
+            cursor.execute("SELECT chat_id FROM users")
+
+    def next_batch():
+        with _db_lock:
+            return cursor.fetchmany(BROADCAST_DB_BATCH)
+
+    await asyncio.to_thread(run_users_query)
+    while True:
+        batch = await asyncio.to_thread(next_batch)
+        if not batch:
+            break
+        await asyncio.gather(*[bounded_send(user[0], chunk) for user in batch for chunk in chunks],
+                             return_exceptions=True)
 
     await update.message.reply_text("Broadcast sent.")
 
 # Help command listing available commands
+_HELP_TEXT = (
+    "/start - Start the bot and track a number (start with + or -)\n"
+    "/broadcast [message] - Send a broadcast message (admin only)\n"
+    "/export - Export your transactions as a CSV file\n"
+    "/graph - Get a graphical report of your transactions\n"
+    "/reset - Reset all your transactions\n"
+    "/status - Check the bot’s current health status\n"
+    "/admin - Admin panel for managing the bot\n"
+    "/clear_cache - Clear cache data (admin only)\n"
+    "/helpme - Display this help message"
+)
+
 async def helpme(update: Update, context):
-    help_text = (
-        "/start - Start the bot and track a number (start with + or -)\n"
-        "/broadcast [message] - Send a broadcast message (admin only)\n"
-        "/export - Export your transactions as a CSV file\n"
-        "/graph - Get a graphical report of your transactions\n"
-        "/reset - Reset all your transactions\n"
-        "/status - Check the bot’s current health status\n"
-        "/admin - Admin panel for managing the bot\n"
-        "/clear_cache - Clear cache data (admin only)\n"
-        "/helpme - Display this help message"
-    )
-    await update.message.reply_text(help_text)
+    await update.message.reply_text(_HELP_TEXT)
 
 # Message handlers
 async def handle_message(update: Update, context):
     text = update.message.text.strip()
     chat_id = update.message.chat.id
-    add_user(chat_id)
+    await asyncio.to_thread(add_user, chat_id)
 
-    match = re.match(r'^[+-]?\d+(\.\d+)?$', text)
-    if match:
-        amount = float(match.group())
-        save_transaction(chat_id, amount)
-        total = get_total(chat_id)
+    # Cheap first-character guard plus C-level float() beats dispatching
+    # into the regex engine, especially for ordinary chat messages
+    amount = None
+    if text and (text[0] in '+-' or text[0].isdigit()):
+        try:
+            amount = float(text)
+        except ValueError:
+            amount = None
+    if amount is not None and math.isfinite(amount):
+        # Usually a pure cache update, but a cold cache hits the DB
+        total = await asyncio.to_thread(save_transaction, chat_id, amount)
 
         await update.message.reply_text(f"Amount added: {amount}\nYour current total: {total}")
 
-        # Notify the group and admin if certain conditions are met
-        await notify_group(chat_id, amount)
-        await notify_admin_if_threshold_exceeded(chat_id, amount)
+        # Notifications don't affect the reply, so don't serialize their
+        # round trips into the handler
+        _spawn(notify_group(chat_id, amount))
+        if amount > TRANSACTION_THRESHOLD:
+            _spawn(notify_admin_if_threshold_exceeded(chat_id, amount))
     else:
         await update.message.reply_text("Please send a valid number starting with + or -.")
 
 # Bot initialization
 def main():
+    init_db_connection()
+    init_db_indexes()
+    load_model()
+
     application = Application.builder().token('7884065680:AAHtLIpdj_1-l3ypC-BvEUde31in2LFkXXQ').build()
 
     # Command handlers mapped in a dictionary
@@ -249,11 +515,12 @@ def main():
 
     # Scheduler for daily reports
     scheduler = AsyncIOScheduler()
+    scheduler.add_job(flush_pending_transactions, 'interval', seconds=FLUSH_INTERVAL)
+    # Retrain the AI-insights model hourly in the background instead of
+    # blocking startup on a full table scan
+    scheduler.add_job(_train_model_job, 'interval', hours=1)
     scheduler.start()
 
-    # Train model for AI insights
-    train_model()
-
     # Start bot
     application.run_polling()
 